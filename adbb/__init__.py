@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import os
 import multiprocessing
 import netrc
@@ -42,6 +43,19 @@ _anidb = None
 _sessionmaker = None
 fanart_key = None
 
+@functools.lru_cache(maxsize=4)
+def _load_netrc(netrc_file, _mtime_ns):
+    # _mtime_ns is only part of the cache key, so an edited file is reparsed.
+    # netrc_file is passed on as given; netrc only checks the permissions of
+    # ~/.netrc when called without a file.
+    return dict(netrc.netrc(netrc_file).hosts)
+
+def netrc_credentials(netrc_file=None):
+    """ Return a dict of host: (login, account, password) from netrc_file, or
+    ~/.netrc if not given """
+    path = netrc_file or os.path.join(os.path.expanduser('~'), '.netrc')
+    return _load_netrc(netrc_file, os.stat(path).st_mtime_ns)
+
 def init(
         sql_db_url,
         api_user=None,
@@ -77,7 +91,7 @@ def init(
     fanart_key = fanart_api_key
 
     try:
-        nrc = netrc.netrc(netrc_file)
+        nrc = netrc_credentials(netrc_file)
     except FileNotFoundError:
         nrc = None
 
@@ -87,7 +101,7 @@ def init(
             raise Exception("User and passwords are required if no netrc file exists")
         for host in ['api.anidb.net', 'api.anidb.info', 'anidb.net']:
             try:
-                username, account, password = nrc.authenticators(host)
+                username, account, password = nrc.get(host, nrc.get('default'))
             except TypeError:
                 continue
             if username and password:
@@ -114,7 +128,7 @@ def init(
             else:
                 username, host = (None, parts[2])
             try:
-                u, _account, password = nrc.authenticators(host)
+                u, _account, password = nrc.get(host, nrc.get('default'))
             except TypeError:
                 u, password = (None, None)
             if password:
@@ -127,7 +141,7 @@ def init(
         if not fanart_key:
             for host in ['fanart.tv', 'assets.fanart.tv', 'webservice.fanart.tv', 'api.fanart.tv']:
                 try:
-                    username, account, password = nrc.authenticators(host)
+                    username, account, password = nrc.get(host, nrc.get('default'))
                 except TypeError:
                     continue
                 key = [x for x in [account, password] if x]
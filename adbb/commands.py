@@ -40,7 +40,7 @@ class Command:
     def authorize(self, session):
         self.session = session
 
-        self.parameters['tag'] = self.tag
+        self.parameters['tag'] = 'T%03d' % self.tag
         self.parameters['s'] = session
 
     def handle(self, resp):
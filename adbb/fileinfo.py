@@ -54,33 +54,39 @@ partfile_re = re.compile(r'[/\._ \-](p)(?:ar)t[/\._ \-]{0,3}([0-9ivx]+)', re.I)
 multiep_re = re.compile(r'[0-9]+')
 specials_re = re.compile(r'^(S|P|C|T|O)([0-9]+)$', re.I)
 
+# ed2k hashes files in chunks of this size
+ed2k_chunk_size = 9728000
+
 
 # http://www.radicand.org/blog/orz/2010/2/21/edonkey2000-hash-in-python/
 def get_file_hash(path, nfs_obj=None):
     if path.startswith('nfs://'):
         with NFSFile(path, 'rb', nfs_obj) as f:
-            return _calculate_ed2khash(f)
+            return _calculate_ed2khash(_read_chunks(f))
     with open(path, 'rb') as f:
-        return _calculate_ed2khash(f)
+        # let the kernel read ahead aggressively, we only go forward
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return _calculate_ed2khash(_read_chunks(f))
 
 
-def _calculate_ed2khash(fileObj):
-    """ Returns the ed2k hash of a given file."""
-    def gen(f):
-        while True:
-            x = f.read(9728000)
-            if x:
-                yield x
-            else:
-                return
+def _read_chunks(f):
+    while True:
+        x = f.read(ed2k_chunk_size)
+        if x:
+            yield x
+        else:
+            return
+
 
+def _calculate_ed2khash(chunks):
+    """ Returns the ed2k hash of a file given as an iterable of chunks."""
     def md4_hash(data):
         m = MD4.new()
         m.update(data)
         return m
 
-    a = gen(fileObj)
-    hashes = [md4_hash(data) for data in a]
+    hashes = [md4_hash(data) for data in chunks]
     if len(hashes) == 1:
         return hashes[0].hexdigest()
     else:
@@ -1,7 +1,6 @@
 import argparse
 import datetime
 import http
-import netrc
 import os
 import random
 import re
@@ -20,7 +19,7 @@ from adbb.errors import *
 import sqlalchemy.exc
 
 # Specials-directories as defined by jellyfin
-JELLYFIN_SPECIAL_DIRS = [
+JELLYFIN_SPECIAL_DIRS = frozenset([
         'behind the scenes',
         'deleted scenes',
         'interviews',
@@ -33,7 +32,7 @@ JELLYFIN_SPECIAL_DIRS = [
         # a few extra for good mesure
         'misc',
         'unsorted' 
-        ]
+        ])
 
 JELLYFIN_ART_TYPES = [
         'logo',
@@ -658,8 +657,8 @@ def jellyfin_anime_sync():
         try:
             if not args.jellyfin_user or not args.jellyfin_password:
                 parsed_url = urllib.parse.urlparse(args.jellyfin_url)
-                nrc = netrc.netrc(args.authfile)
-                user, _account, password = nrc.authenticators(parsed_url.hostname)
+                nrc = adbb.netrc_credentials(args.authfile)
+                user, _account, password = nrc.get(parsed_url.hostname, nrc.get('default'))
             else:
                 user, password = (args.jellyfin_user, args.jellyfin_password)
 
@@ -698,7 +697,7 @@ def jellyfin_anime_sync():
             full_path_list = []
             for root, dirs, files in os.walk(args.path):
                 dirs[:] = [d for d in dirs if d.lower() not in JELLYFIN_SPECIAL_DIRS]
-                files[:] = [ x for x in files if x.rsplit('.')[-1] in adbb.utils.SUPPORTED_FILETYPES ]
+                files[:] = [ x for x in files if x.endswith(adbb.utils.SUPPORTED_EXTS) ]
                 if files:
                     full_path_list.append(root)
             random.shuffle(full_path_list)
@@ -715,7 +714,7 @@ def jellyfin_anime_sync():
                 iterations += 1
                 for root, dirs, files in os.walk(path):
                     dirs[:] = []
-                    files[:] = [ x for x in files if x.rsplit('.')[-1] in adbb.utils.SUPPORTED_FILETYPES ]
+                    files[:] = [ x for x in files if x.endswith(adbb.utils.SUPPORTED_EXTS) ]
                     if '/Movies/' in root:
                         single_ep = True
                     else:
@@ -763,9 +762,9 @@ def jellyfin_anime_sync():
                                 callback=link_to_library)
 
                         if args.staging_path:
-                            files = adbb.utils.create_filelist([args.staging_path])
                             adbb.utils.arrange_files(
-                                    files, target_dir=args.path,
+                                    adbb.utils.iter_files([args.staging_path]),
+                                    target_dir=args.path,
                                     dry_run=args.dry_run,
                                     check_previous=args.check_previous_episode,
                                     check_complete=args.check_series_complete,
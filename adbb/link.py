@@ -17,10 +17,12 @@
 
 import datetime
 import hashlib
+import itertools
+import queue
+import selectors
 import socket, sys, zlib
 import threading
-from time import time, sleep
-from collections import deque
+from time import monotonic_ns, sleep
 
 from adbb.responses import ResponseResolver
 from adbb.errors import *
@@ -43,9 +45,16 @@ class AniDBLink(threading.Thread):
         self._user = user
         self._pwd = pwd
         self._server = (host, port)
-        self._queue = deque()
+        # entries are (priority, sequence, command); the sequence keeps
+        # commands of equal priority in FIFO order and a command of None
+        # tells the sender thread to exit.
+        self._queue = queue.PriorityQueue()
+        self._queue_seq = itertools.count()
 
+        # timestamps from monotonic_ns(); 0 means nothing has been sent yet
         self._last_packet = 0
+        self._last_refill = 0
+        self._burst_tokens = 5
         self._counter = 0
         self._banned = 0
 
@@ -60,6 +69,8 @@ class AniDBLink(threading.Thread):
         self._authed = threading.Event()
         self._authenticating = threading.Event()
         self._auth_lock = threading.Lock()
+        # request() is called from several threads at once
+        self._tag_lock = threading.Lock()
         self._session = None
 
         self._api_key=api_key
@@ -124,41 +135,63 @@ class AniDBLink(threading.Thread):
         adbb.log.info(f"Logged in to AniDB with session {self._session}")
 
     def _new_tag(self):
-        if self._current_tag >= 999:
-            self._current_tag = 0
-            newtag = "TOOO"
-        else:
-            self._current_tag += 1
-            newtag = "T{:03d}".format(self._current_tag)
-        return newtag
+        # tags are kept as integers 1-999 and only formatted when the
+        # command is sent
+        self._current_tag = self._current_tag % 999 + 1
+        return self._current_tag
 
     def _do_delay(self):
         if self._banned > 0:
             delay = 1800*self._banned
             adbb.log.warning(f"API not available, will wait for {delay/60} minutes")
             sleep(delay)
-        age = time() - self._last_packet
-        if age > 600:
+        now = monotonic_ns()
+        age = now - self._last_packet
+        if not self._last_packet or age > 600_000_000_000:
             self._counter = 0
-            delay = 0
-        elif self._counter < 5:
-            delay = 2
+            self._burst_tokens = 5
         else:
-            delay = 4
-        delay = delay-age
+            self._refill_tokens(now)
+        self._last_refill = now
+
+        # AniDB accepts a burst of 5 packets, after that no more than one
+        # packet every 2 seconds and one every 4 seconds in the long run.
+        delay = 0
+        if self._burst_tokens < 1:
+            delay = int((1 - self._burst_tokens) * 4_000_000_000)
+        if self._counter >= 5:
+            delay = max(delay, 2_000_000_000 - age)
         if delay > 0:
-            adbb.log.debug("Delaying request with {} seconds".format(delay))
-            sleep(delay)
+            adbb.log.debug("Delaying request with {} seconds".format(delay / 1_000_000_000))
+            sleep(delay / 1_000_000_000)
+            now = monotonic_ns()
+            self._refill_tokens(now)
+            self._last_refill = now
+        self._burst_tokens = max(0, self._burst_tokens - 1)
+
+    def _refill_tokens(self, now):
+        self._burst_tokens = min(5, self._burst_tokens + (now - self._last_refill) / 4_000_000_000)
 
     def _ping_callback(self, _resp):
         adbb.log.debug(f"Successful session refresh")
 
+    def _enqueue(self, command, prio=False):
+        self._queue.put((0 if prio else 1, next(self._queue_seq), command))
+
+    def _idle_wait(self):
+        # seconds until the session may need a keepalive
+        interval = self._nat_ping_interval if self._do_ping else 1800
+        wait = interval - (monotonic_ns() - self._last_packet) / 1_000_000_000
+        if wait <= 0:
+            wait = interval
+        return wait
+
     def run(self):
-        # can't figure out a better way than to do a busy-wait here :/
         while True:
-            while len(self._queue) < 1:
-                sleep(0.2)
-                time_since_cmd = time()-self._last_packet
+            try:
+                _prio, _seq, command = self._queue.get(timeout=self._idle_wait())
+            except queue.Empty:
+                time_since_cmd = (monotonic_ns()-self._last_packet) / 1_000_000_000
                 if self._authed.is_set() \
                         and self._do_ping \
                         and time_since_cmd > self._nat_ping_interval:
@@ -168,8 +201,10 @@ class AniDBLink(threading.Thread):
                     command = adbb.commands.UptimeCommand()
                     adbb.log.debug("Session idle for 30 minutes, sending UPTIME command")
                     self.request(command, self._ping_callback)
+                continue
 
-            command = self._queue.pop()
+            if command is None:
+                break
             adbb.log.debug("sending command {} with tag {}".format(
                     command.command, command.tag))
             if self._authed.is_set() or command.command in ('AUTH', 'ENCRYPT', 'PING'):
@@ -197,8 +232,8 @@ class AniDBLink(threading.Thread):
             return
         command.authorize(self._session)
         self._counter += 1
-        self._last_packet = time()
-        command.started = time()
+        self._last_packet = monotonic_ns()
+        command.started = self._last_packet
         data = command.raw_data().encode('utf-8')
         if self._listener._cipher:
             data = self._listener.encrypt(data)
@@ -213,22 +248,20 @@ class AniDBLink(threading.Thread):
         except socket.gaierror as e:
             adbb.log.warning(f'Failed to send command {command.command}: {e}')
             if command.command not in ('AUTH', 'PING', 'ENCRYPT'):
-                self._queue.append(command)
+                self._enqueue(command, prio=True)
             self.set_banned(code=999, reason=b'Network unavailable')
 
     def request(self, command, callback, prio=False):
         command.started = None
         command.callback = callback
-        command.tag = self._new_tag()
-        self._listener.cmd_queue[command.tag] = command
+        with self._tag_lock:
+            command.tag = self._new_tag()
+            self._listener.cmd_queue[command.tag] = command
         adbb.log.debug("Queued command {} with tag {}".format( command.command, command.tag))
         if command.command in ('ENCRYPT', 'AUTH', 'PING'):
             self._send_command(command)
             return
-        if prio:
-            self._queue.append(command)
-        else:
-            self._queue.appendleft(command)
+        self._enqueue(command, prio=prio)
 
     def set_session(self, session):
         self._session = session
@@ -247,13 +280,16 @@ class AniDBLink(threading.Thread):
             self._stop.wait(self.timeout)
         else:
             self._listener.stop()
+        # sorts after any pending command
+        self._queue.put((2, next(self._queue_seq), None))
 
     def set_banned(self, code, reason=None):
         adbb.log.error("Backing off: {}".format(reason))
+        # back off exponentially from 30 minutes, but never more than 48 hours
         if not self._banned:
             self._banned = 1
         else:
-            self._banned *= 2
+            self._banned = min(self._banned * 2, 96)
         with self._auth_lock:
             self._authenticating.clear()
         self.reauthenticate()
@@ -271,7 +307,7 @@ class AniDBListener(threading.Thread):
         self.sock = self._connect_socket(myport, self.timeout)
         self._sender = sender
         self._cipher = None
-        self._last_receive = time()
+        self._last_receive = monotonic_ns()
 
         self.cmd_queue = {}
 
@@ -306,11 +342,26 @@ class AniDBListener(threading.Thread):
         adbb.log.debug("Closing listening socket")
         self._disconnect_socket()
 
+    def _next_deadline(self):
+        # wake up when the oldest in-flight command times out, but at least
+        # every timeout seconds so that a closed socket is noticed
+        wait = self.timeout
+        now = monotonic_ns()
+        for cmd in list(self.cmd_queue.values()):
+            if cmd and cmd.started:
+                wait = min(wait, self.timeout - (now - cmd.started) / 1_000_000_000)
+        return max(wait, 0)
+
     def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
         while self.sock:
-            self.sock.settimeout(self.timeout)
+            wait = self._next_deadline()
+            adbb.log.debug("Listening on socket with {:.1f}s timeout".format(wait))
             try:
-                adbb.log.debug("Listening on socket with {}s timeout".format(self.sock.gettimeout()))
+                if not selector.select(wait):
+                    self._handle_timeouts()
+                    continue
                 data = self.sock.recv(8192)
             except socket.timeout:
                 self._handle_timeouts()
@@ -323,13 +374,16 @@ class AniDBListener(threading.Thread):
                     data = self.decrypt(data)
                 except ValueError:
                     pass
-            for i in range(2):
-                tmp = data
-                resp = None
-                if tmp[:2] == b'\x00\x00':
-                    tmp = zlib.decompressobj().decompress(tmp[2:])
-                    adbb.log.debug("UnZip | %s" % repr(tmp))
-                resp = ResponseResolver(tmp)
+            tmp = data
+            if tmp[:2] == b'\x00\x00':
+                # every datagram is a complete deflate stream
+                try:
+                    tmp = zlib.decompress(tmp[2:])
+                except zlib.error as e:
+                    adbb.log.warning(f"Failed to decompress response: {e}")
+                    continue
+                adbb.log.debug("UnZip | %s" % repr(tmp))
+            resp = ResponseResolver(tmp)
             if not resp:
                 adbb.log.warning(f"Invalid response: {data}")
                 continue
@@ -360,7 +414,7 @@ class AniDBListener(threading.Thread):
                 else:
                     adbb.log.critical(f'Unhandled response from API: {repr(data)}')
                     sys.exit(2)
-                self._last_receive = time()
+                self._last_receive = monotonic_ns()
                 continue
             resp = resp.resolve(cmd)
             resp.parse()
@@ -373,27 +427,29 @@ class AniDBListener(threading.Thread):
                     adbb.log.warning('Lost session with AniDB; attempting to reauthenticate')
                     self._sender.reauthenticate()
                     self._sender.request(cmd, cmd.callback, prio=True)
-                self._last_receive = time()
+                self._last_receive = monotonic_ns()
                 continue
             elif resp.rescode in ('203', '500', '503'):
                 self.stop()
 
-            self._last_receive = time()
+            self._last_receive = monotonic_ns()
             resp_thread = threading.Thread(target=resp.handle)
             resp_thread.daemon = True
             resp_thread.start()
+        selector.close()
 
     def _handle_timeouts(self):
         willpop = []
         cmd = None
-        now = time()
-        for tag, cmd in self.cmd_queue.items():
+        now = monotonic_ns()
+        timeout = self.timeout * 1_000_000_000
+        for tag, cmd in list(self.cmd_queue.items()):
             if not tag:
                 continue
             if cmd.started:
-                adbb.log.debug("Command {} started at {} (now {})".format(
-                        tag, cmd.started, time()))
-                if now - cmd.started > self.timeout:
+                adbb.log.debug("Command {} started {:.1f}s ago".format(
+                        tag, (now - cmd.started) / 1_000_000_000))
+                if now - cmd.started > timeout:
                     willpop.append(tag)
 
         for tag in willpop:
@@ -22,29 +22,31 @@ from types import FunctionType
 class ResponseResolver:
     def __init__(self, data):
         data = data.decode('utf-8')
-        restag, rescode, resstr, datalines = self.parse(data)
+        resline, _sep, self._body = data.partition('\n')
+        restag, rescode, resstr = self.parse(resline)
 
         self.restag = restag
         self.rescode = rescode
         self.resstr = resstr
-        self.datalines = datalines
-
-    def parse(self, data):
-        resline = data.split('\n', 1)[0]
-        lines = data.split('\n')[1:-1]
+        self._datalines = None
 
+    def parse(self, resline):
         rescode, resstr = resline.split(' ', 1)
         if rescode[0] == 'T':
-            restag = rescode
+            # link.AniDBLink uses integer tags
+            restag = int(rescode[1:]) if rescode[1:].isdigit() else rescode
             rescode, resstr = resstr.split(' ', 1)
         else:
             restag = None
 
-        datalines = []
-        for line in lines:
-            datalines.append(line.split('|'))
+        return restag, rescode, resstr
 
-        return restag, rescode, resstr, datalines
+    @property
+    def datalines(self):
+        # only split the data lines of responses that are actually resolved
+        if self._datalines is None:
+            self._datalines = [line.split('|') for line in self._body.split('\n')[:-1]]
+        return self._datalines
 
     def resolve(self, cmd):
         return responses[self.rescode](cmd, self.restag, self.rescode, self.resstr, self.datalines)
@@ -1,6 +1,9 @@
 #!/bin/env python3
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import errno
 import logging
 import os
 import re
@@ -20,7 +23,7 @@ status_msg=None
 ignorelist=set()
 
 # These extensions are considered video types
-SUPPORTED_FILETYPES = [
+SUPPORTED_FILETYPES = frozenset([
         'mkv',
         'avi',
         'mp4',
@@ -28,16 +31,16 @@ SUPPORTED_FILETYPES = [
         'wmv',
         'm4v',
         'webm',
-        ]
+        ])
+SUPPORTED_EXTS = tuple(f'.{x}' for x in SUPPORTED_FILETYPES)
 
-EXTRAS_DIRS = [
+EXTRAS_DIRS = frozenset([
         'extras'
-        ]
+        ])
 
-# matches groupnames from paranthesis at start of filename
-RE_GROUP_START = re.compile(r'^[\(\[]([^\d\]\)]+)[\)\]].*')
-# matches groupnames from paranthesis at end of filename
-RE_GROUP_END = re.compile(r'^.*[\(\[]([^\d\]\)]+)[\)\]].*')
+# matches groupnames from paranthesis at start of filename, or failing that
+# the last paranthesis in the filename
+RE_GROUP = re.compile(r'^(?:[\(\[](?P<start>[^\d\]\)]+)[\)\]]|.*[\(\[](?P<end>[^\d\]\)]+)[\)\]])')
 
 # matches anidb's default english episode names
 RE_DEFAULT_EPNAME = re.compile(r'Episode S?\d+', re.I)
@@ -152,18 +155,82 @@ def arrange_anime_args():
             )
     return parser.parse_args()
 
-def create_filelist(paths, recurse=True, ignore_dirs=EXTRAS_DIRS):
-    filelist = []
+def iter_files(paths, recurse=True, ignore_dirs=EXTRAS_DIRS):
+    """ Yield all files with supported file extensions found in the given
+    directories """
+    ignore_dirs = frozenset(ignore_dirs)
+
+    def scan(path):
+        # read the whole directory before yielding so that files renamed by
+        # the consumer are not picked up again
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # like os.walk we do not follow symlinked directories
+                if recurse and not entry.is_symlink() \
+                        and entry.name.lower() not in ignore_dirs:
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(SUPPORTED_EXTS):
+                yield entry.path
+        for d in subdirs:
+            yield from scan(d)
+
     for path in paths:
-        # find all files with supported file extensions and add them to
-        # our working list if input is a directory.
         if os.path.isdir(path):
-            for root, dirs, files in os.walk(path):
-                dirs[:] = [d for d in dirs if d.lower() not in ignore_dirs]
-                filelist.extend([ os.path.join(root, x) for x in files if x.rsplit('.')[-1] in SUPPORTED_FILETYPES ])
-                if not recurse:
+            yield from scan(path)
+
+def create_filelist(paths, recurse=True, ignore_dirs=EXTRAS_DIRS):
+    return list(iter_files(paths, recurse=recurse, ignore_dirs=ignore_dirs))
+
+def _copy_file(source, target):
+    """ copy_function for shutil.move; copy file content with
+    copy_file_range where possible, which lets the kernel reflink or copy
+    server-side instead of going through userspace """
+    if not hasattr(os, 'copy_file_range'):
+        return shutil.copy2(source, target)
+    with open(source, 'rb') as fsrc, open(target, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+                if not n:
                     break
-    return filelist
+                remaining -= n
+        except OSError as e:
+            # not supported between these filesystems
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            remaining = -1
+    if remaining != 0:
+        return shutil.copy2(source, target)
+    shutil.copystat(source, target)
+    return target
+
+def _move_extras(directory, target_dir, dry_run=False, companion_dirs=EXTRAS_DIRS):
+    """ Make sure extras-directories are moved if it's all that is left in
+    the old directory """
+    log = logging.getLogger(__name__)
+    dirs = os.listdir(directory)
+    if all([x.lower() in companion_dirs for x in dirs]):
+        for d in dirs:
+            spath = os.path.join(directory, d)
+            tpath = os.path.join(target_dir, d)
+            log.info(f'Move Extras {spath} -> {tpath}')
+            if not dry_run:
+                if 'freebsd' in sys.platform.lower():
+                    shutil.copytree(spath, tpath)
+                    shutil.rmtree(spath)
+                else:
+                    try:
+                        shutil.move(spath, tpath)
+                    except OSError:
+                        shutil.copytree(spath, tpath)
+                        shutil.rmtree(spath)
 
 def fsop(source, target, link=False, dry_run=False, skip_clean=False, companion_dirs=EXTRAS_DIRS):
     """ Remove, move or link files and any related file (same basename, other
@@ -173,11 +240,13 @@ def fsop(source, target, link=False, dry_run=False, skip_clean=False, companion_
     directory, name = os.path.split(source)
     basename = name.rsplit('.', 1)[0]
     dir_content = os.listdir(directory)
-    all_files = [x for x in dir_content if x.startswith(f'{basename}.')]
+    prefix = f'{basename}.'
+    all_files = [x for x in dir_content if x.startswith(prefix)]
     specials = [x for x in dir_content if x.lower() in companion_dirs]
 
     if target:
         target_dir, target_name = os.path.split(target)
+        target_base = target_name.rsplit('.', 1)[0]
         if not dry_run:
             os.makedirs(target_dir, exist_ok=True)
     else:
@@ -195,7 +264,6 @@ def fsop(source, target, link=False, dry_run=False, skip_clean=False, companion_
 
         # Move or link 
         ext = f.rsplit('.', 1)[-1]
-        target_base = target_name.rsplit('.', 1)[0]
         target_name = f'{target_base}.{ext}'
         target_path = os.path.join(target_dir, target_name)
 
@@ -208,10 +276,10 @@ def fsop(source, target, link=False, dry_run=False, skip_clean=False, companion_
                     os.remove(path)
                 else:
                     try:
-                        shutil.move(path, target_path)
+                        shutil.move(path, target_path, copy_function=_copy_file)
                     except OSError:
                         shutil.copy2(path, target_path)
-                        os.remove(f)
+                        os.remove(path)
             continue
 
         # Link
@@ -224,24 +292,8 @@ def fsop(source, target, link=False, dry_run=False, skip_clean=False, companion_
             os.utime(target_path, ns=(stats.st_atime_ns, stats.st_mtime_ns), follow_symlinks=False)
 
     if not link:
-        # Make sure extras-directories are moved if it's all that is
-        # left in the old directory
-        dirs = os.listdir(directory)
-        if all([x.lower() in companion_dirs for x in dirs]):
-            for d in dirs:
-                spath = os.path.join(directory, d)
-                tpath = os.path.join(target_dir, d)
-                log.info(f'Move Extras {spath} -> {tpath}')
-                if not dry_run:
-                    if 'freebsd' in sys.platform.lower():
-                        shutil.copytree(spath, tpath)
-                        shutil.rmtree(spath)
-                    else:
-                        try:
-                            shutil.move(spath, tpath)
-                        except OSError:
-                            shutil.copytree(spath, tpath)
-                            shutil.rmtree(spath)
+        if target_dir:
+            _move_extras(directory, target_dir, dry_run=dry_run, companion_dirs=companion_dirs)
     elif target_dir and os.path.isdir(target_dir):
         # Make sure to link any extras directories in the source path to the
         # target path
@@ -307,6 +359,37 @@ def link_to_directory(target, linkname, exclusive_dir=None, dry_run=False):
                 if os.path.islink(p) and os.readlink(p) == target:
                     fsop(p, None, dry_run=dry_run)
 
+def _load_file(path):
+    epfile = adbb.File(path=path)
+    # resolve what arrange_files needs while other files are being hashed
+    epfile.group
+    epfile.anime
+    return epfile
+
+def _prefetch_files(filelist, depth=2):
+    """ Yield (path, future) for each path not in the ignorelist, while a
+    single worker resolves the next adbb.File objects. One worker is enough
+    to overlap hashing and AniDB lookups with renaming; more would only
+    hash several files at once and all packets still go through the one
+    AniDBLink sender. """
+    # the title list is loaded lazily without locking; make sure the worker
+    # and the rename loop do not both try to fetch it
+    if adbb.anames.titles is None:
+        adbb.anames.update_animetitles()
+    pending = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        for f in filelist:
+            if f in ignorelist:
+                continue
+            pending.append((f, executor.submit(_load_file, f)))
+            if len(pending) >= depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
 # The callback will be called for each file after the file has been put in
 # place
 # The callback function should take the keyword arguments:
@@ -326,152 +409,180 @@ def arrange_files(
         ):
     global ignorelist
     log = logging.getLogger(__name__)
-    for f in [i for i in filelist if not i in ignorelist]:
-        try:
-            epfile = adbb.File(path=f)
-            if epfile.group:
-                # replace any / since it's not supported for filenames in *nix
-                group = epfile.group.name.replace('/', '⁄')
-            else:
-                # if anidb don't know about the group we try to parse the filename
-                # look for [] or ()-blocks at start or end of filename, and assume this
-                # is the groupname.
-                m = re.match(RE_GROUP_START, os.path.split(f)[-1])
-                if not m:
-                    m = re.match(RE_GROUP_END, os.path.split(f)[-1])
-                if m:
-                    # since we matched on filename previously there is no need to
-                    # replace any chars here.
-                    group = m.group(1)
-                else:
-                    group = "unknown"
-        except IllegalAnimeObject:
-            log.error(f"Ignoring file '{f}': unknown Anime/Episode")
-            ignorelist.add(f)
-            continue
-
-        # how many characters in an episode number? will probably return 1 (<10
-        # episodes), 2 (<100 episodes), 3 (<1000 episodes) or 4 (hello Conan
-        # and Luffy)
-        epnr_minlen = len(str(max(epfile.anime.highest_episode_number, epfile.anime.nr_of_episodes)))
 
-        aname = epfile.anime.title.replace('/', '⁄').lstrip('.')
-        ext = f.rsplit('.')[-1]
-        is_extra=False
-        if epfile.anime.nr_of_episodes == 1:
+    # If target directory has separate subdirs for movies and series;
+    # place the files there
+    if target_dir:
+        movie_dir = os.path.join(target_dir, 'Movies')
+        series_dir = os.path.join(target_dir, 'Series')
+        has_movie_dir = os.path.isdir(movie_dir)
+        has_series_dir = os.path.isdir(series_dir)
 
-            # Check if anidb knows if this is a specific version
-            if epfile.file_version and epfile.file_version != 1:
-                vstr = f'v{epfile.file_version}'
-            else:
-                vstr = ''
+    # (aname, nr_of_episodes, epnr_minlen) per aid
+    anime_info = {}
 
-            # personal definition of movies: exactly 1 (main-)episode.
-            # Name movies after title and append groupname to mark different
-            # "versions" of the movie:
-            #   https://jellyfin.org/docs/general/server/media/movies.html
-            newname = f'{aname} [{group}]{vstr}.{ext}'
+    # source and target directories of moved files. These are cleaned up
+    # once all files have been processed rather than after every move.
+    moved_from = set()
+    moved_to = set()
 
-            # But wait, what if this is just a part of the movie?
-            if epfile.part:
-                newname = f'{aname} [{group}]{vstr}-part{epfile.part}.{ext}'
-        else:
-            # Use the first found of these titles:
-            # * romanji
-            # * kanji
-            # * english (if set to anything other than default "Episode XX")
-            #
-            # If no title was found we do not append it to the filename
-            if epfile.episode.title_romaji:
-                title = f' - {epfile.episode.title_romaji}'.replace('/', '⁄')
-            elif epfile.episode.title_kanji:
-                title = f' - {epfile.episode.title_kanji}'.replace('/', '⁄')
-            elif epfile.episode.title_eng and not re.match(RE_DEFAULT_EPNAME, epfile.episode.title_eng):
-                title = f' - {epfile.episode.title_eng}'.replace('/', '⁄')
-            else:
-                title = ''
+    try:
+        for f, future in _prefetch_files(filelist):
+            try:
+                epfile = future.result()
+                if epfile.group:
+                    # replace any / since it's not supported for filenames in *nix
+                    group = epfile.group.name.replace('/', '⁄')
+                else:
+                    # if anidb don't know about the group we try to parse the filename
+                    # look for [] or ()-blocks at start or end of filename, and assume this
+                    # is the groupname.
+                    m = RE_GROUP.match(os.path.basename(f))
+                    if m:
+                        # since we matched on filename previously there is no need to
+                        # replace any chars here.
+                        group = m.group('start') or m.group('end')
+                    else:
+                        group = "unknown"
+            except IllegalAnimeObject:
+                log.error(f"Ignoring file '{f}': unknown Anime/Episode")
+                ignorelist.add(f)
+                continue
 
-            m = re.match(adbb.fileinfo.specials_re, epfile.multiep[0])
-            if m:
-                epnr_minlen = len(str(epfile.anime.special_ep_count))
-                if m.group(1).upper() == 'S':
-                    season='0'
+            anime = epfile.anime
+            if anime.aid not in anime_info:
+                # Escape slash as usual, but for also remove dot-prefixes because
+                # "Hidden" directories are a hastle; sorry .hack//...
+                aname = anime.title.replace('/', '⁄').lstrip('.')
+                nr_of_episodes = anime.nr_of_episodes
+                # how many characters in an episode number? will probably return 1 (<10
+                # episodes), 2 (<100 episodes), 3 (<1000 episodes) or 4 (hello Conan
+                # and Luffy)
+                epnr_minlen = len(str(max(anime.highest_episode_number, nr_of_episodes)))
+                anime_info[anime.aid] = (aname, nr_of_episodes, epnr_minlen)
+            aname, nr_of_episodes, epnr_minlen = anime_info[anime.aid]
+            ext = f.rsplit('.', 1)[-1]
+            is_extra=False
+            if nr_of_episodes == 1:
+
+                # Check if anidb knows if this is a specific version
+                if epfile.file_version and epfile.file_version != 1:
+                    vstr = f'v{epfile.file_version}'
                 else:
-                    is_extra=True
-            else:
-                season='1'
+                    vstr = ''
 
-            # check if file contains multiple episodes
-            if len(epfile.multiep) > 1:
-                mi = int(epfile.multiep[0].strip('SCTOPsctop'))
-                ma = int(epfile.multiep[-1].strip('SCTOPsctop'))
-                epstr = f'{mi:0{epnr_minlen}d}-{ma:0{epnr_minlen}d}'
-            else:
-                epstr = f'{int(epfile.multiep[0].strip("SCTOPsctop")):0{epnr_minlen}d}'
+                # personal definition of movies: exactly 1 (main-)episode.
+                # Name movies after title and append groupname to mark different
+                # "versions" of the movie:
+                #   https://jellyfin.org/docs/general/server/media/movies.html
+                newname = f'{aname} [{group}]{vstr}.{ext}'
 
-            # Is the file versioned?
-            if epfile.file_version and epfile.file_version != 1:
-                vstr = f'v{epfile.file_version}'
+                # But wait, what if this is just a part of the movie?
+                if epfile.part:
+                    newname = f'{aname} [{group}]{vstr}-part{epfile.part}.{ext}'
             else:
-                vstr = ''
+                # Use the first found of these titles:
+                # * romanji
+                # * kanji
+                # * english (if set to anything other than default "Episode XX")
+                #
+                # If no title was found we do not append it to the filename
+                episode = epfile.episode
+                if episode.title_romaji:
+                    title = episode.title_romaji
+                elif episode.title_kanji:
+                    title = episode.title_kanji
+                elif episode.title_eng and not RE_DEFAULT_EPNAME.match(episode.title_eng):
+                    title = episode.title_eng
+                else:
+                    title = None
+                title = f' - {title}'.replace('/', '⁄') if title else ''
 
-            if is_extra:
-                newname = f'{aname} {m.group(1)}{epstr}{title} [{group}]{vstr}.{ext}'
-                if len(newname.encode('utf8')) > 250:
-                    newname = f'{aname} {m.group(1)}{epstr} [{group}]{vstr}.{ext}'
-                newname = os.path.join('extras', newname)
-            else:
-                newname = f'{aname} S{season}E{epstr}{title} [{group}]{vstr}.{ext}'
-                if len(newname.encode('utf8')) > 250:
-                    newname = f'{aname} S{season}E{epstr} [{group}]{vstr}.{ext}'
+                multiep = epfile.multiep
+                m = adbb.fileinfo.specials_re.match(multiep[0])
+                if m:
+                    epnr_minlen = len(str(anime.special_ep_count))
+                    if m.group(1).upper() == 'S':
+                        season='0'
+                    else:
+                        is_extra=True
+                else:
+                    season='1'
 
+                # check if file contains multiple episodes
+                if len(multiep) > 1:
+                    mi = int(multiep[0].strip('SCTOPsctop'))
+                    ma = int(multiep[-1].strip('SCTOPsctop'))
+                    epstr = f'{mi:0{epnr_minlen}d}-{ma:0{epnr_minlen}d}'
+                else:
+                    epstr = f'{int(multiep[0].strip("SCTOPsctop")):0{epnr_minlen}d}'
 
-        if target_dir:
-            # Escape slash as usual, but for also remove dot-prefixes because
-            # "Hidden" directories are a hastle; sorry .hack//...
-            anime_dirname = epfile.anime.title.replace('/', '⁄').lstrip('.')
-            movie_subdir = 'Movies'
-            series_subdir = 'Series'
-            # If target directory has separate subdirs for movies and series;
-            # place the files there
-            if os.path.isdir(os.path.join(target_dir, movie_subdir)) and epfile.anime.nr_of_episodes == 1:
-                newname = os.path.join(target_dir, movie_subdir, anime_dirname, newname)
-            elif os.path.isdir(os.path.join(target_dir, series_subdir)):
-                newname = os.path.join(target_dir, series_subdir, anime_dirname, newname)
-            else:
-                newname = os.path.join(target_dir, anime_dirname, newname)
+                # Is the file versioned?
+                if epfile.file_version and epfile.file_version != 1:
+                    vstr = f'v{epfile.file_version}'
+                else:
+                    vstr = ''
 
-        # no action if file is already properly named and in the right place
-        if f != newname:
-            if os.path.exists(newname):
-                adbb.log.error(f'Not moving "{f}" because file "{newname}" already exists')
-                continue
-            fsop(f, newname, dry_run=dry_run)
-
-            if not (dry_run or epfile.lid or disable_mylist):
-                if check_complete:
-                    last_ep = epfile.multiep[-1]
-                    if last_ep == str(epfile.anime.nr_of_episodes):
-                        adbb.log.warning(f'Adding last episode ({last_ep}) of {epfile.anime.title} to mylist')
-                if check_previous:
-                    try:
-                        prev_epno = int(epfile.episode.episode_number)-1
-                    except ValueError:
-                        prev_epno = -1
-                    if prev_epno > 0:
-                        prev_ep = adbb.File(anime=epfile.anime, episode=prev_epno)
-                        if not prev_ep.lid:
-                            adbb.log.warning(f'Adding episode {epfile.episode.episode_number} of {epfile.anime.title} to mylist, but episode {prev_epno} is not in mylist!')
-
-                for e in epfile.multiep:
-                    if str(e).lower() == str(epfile.episode.episode_number).lower():
-                        epfile.update_mylist(watched=False, state='on hdd')
-                    else:
-                        tmpfile = adbb.File(anime=epfile.anime, episode=e)
-                        tmpfile.update_mylist(watched=False, state='on hdd')
+                if is_extra:
+                    newname = f'{aname} {m.group(1)}{epstr}{title} [{group}]{vstr}.{ext}'
+                    if len(newname.encode('utf8')) > 250:
+                        newname = f'{aname} {m.group(1)}{epstr} [{group}]{vstr}.{ext}'
+                    newname = os.path.join('extras', newname)
+                else:
+                    newname = f'{aname} S{season}E{epstr}{title} [{group}]{vstr}.{ext}'
+                    if len(newname.encode('utf8')) > 250:
+                        newname = f'{aname} S{season}E{epstr} [{group}]{vstr}.{ext}'
 
-        if callback:
-            callback(path=newname, adbb_file=epfile)
+
+            if target_dir:
+                if nr_of_episodes == 1 and has_movie_dir:
+                    newname = os.path.join(movie_dir, aname, newname)
+                elif has_series_dir:
+                    newname = os.path.join(series_dir, aname, newname)
+                else:
+                    newname = os.path.join(target_dir, aname, newname)
+
+            # no action if file is already properly named and in the right place
+            if f != newname:
+                if os.path.exists(newname):
+                    adbb.log.error(f'Not moving "{f}" because file "{newname}" already exists')
+                    continue
+                fsop(f, newname, dry_run=dry_run, skip_clean=True)
+                moved_from.add(os.path.dirname(f))
+                moved_to.add(os.path.dirname(newname))
+
+                if not (dry_run or epfile.lid or disable_mylist):
+                    episode = epfile.episode
+                    multiep = epfile.multiep
+                    if check_complete:
+                        last_ep = multiep[-1]
+                        if last_ep == str(nr_of_episodes):
+                            adbb.log.warning(f'Adding last episode ({last_ep}) of {anime.title} to mylist')
+                    if check_previous:
+                        try:
+                            prev_epno = int(episode.episode_number)-1
+                        except ValueError:
+                            prev_epno = -1
+                        if prev_epno > 0:
+                            prev_ep = adbb.File(anime=anime, episode=prev_epno)
+                            if not prev_ep.lid:
+                                adbb.log.warning(f'Adding episode {episode.episode_number} of {anime.title} to mylist, but episode {prev_epno} is not in mylist!')
+
+                    for e in multiep:
+                        if str(e).lower() == str(episode.episode_number).lower():
+                            epfile.update_mylist(watched=False, state='on hdd')
+                        else:
+                            tmpfile = adbb.File(anime=anime, episode=e)
+                            tmpfile.update_mylist(watched=False, state='on hdd')
+
+            if callback:
+                callback(path=newname, adbb_file=epfile)
+    finally:
+        # Clean up broken links at both source and target and remove
+        # directories if empty
+        for directory in moved_from | moved_to:
+            if os.path.isdir(directory):
+                remove_dir_if_empty(directory, dry_run=dry_run)
 
 def arrange_anime():
     args = arrange_anime_args()